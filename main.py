@@ -1,8 +1,18 @@
 import os
 import io
+import math
 import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
 import traceback
-import hashlib
+import uuid
+from collections import Counter
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
 from flask_cors import CORS
@@ -15,6 +25,9 @@ from reportlab.platypus import (
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors
 import camelot
+import numpy as np
+import re2
+import xxhash
 
 
 # --- GLOBAL SETTINGS ---
@@ -24,14 +37,197 @@ import camelot
 # if an embedded image is detected or the text extraction is poor.
 FORCE_RASTERIZE_ALL_TABLES = True
 
+# Rasterization backend used by Camelot's lattice parser. "pdfium" is much
+# faster than Ghostscript; use "ghostscript" if pypdfium2 is not available.
+CAMELOT_BACKEND = "pdfium"
+
+# Maximum number of uploads processed at the same time. Further uploads are
+# queued and picked up as soon as a running job finishes.
+MAX_CONCURRENT_JOBS = 2
+
+# Seconds a finished job's result is kept if the client never fetches it.
+JOB_RESULT_TTL = 3600
+
+# Number of leading bytes of an image hashed for its deduplication key.
+# Full contents are only compared when two images share length and prefix.
+HASH_PREFIX_BYTES = 65536
+
 # --- FLASK APP SETUP ---
 app = Flask(__name__)
 CORS(app)
 app.config['UPLOAD_FOLDER'] = 'extract_file'
 
+# --- WORKING DIRECTORIES ---
+# Created once at startup; worker processes only create unique subdirectories
+TEMP_IMAGE_DIR = "temp_extracted_images"
+OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "generate-pdf")
+for _dir in (app.config['UPLOAD_FOLDER'], TEMP_IMAGE_DIR, OUTPUT_DIR):
+    os.makedirs(_dir, exist_ok=True)
+
+# --- BACKGROUND JOBS ---
+# Extraction and the PDF build run in a separate worker process so the web
+# worker stays responsive; clients poll /result/<job_id> for the output.
+# `_jobs` maps each job id to its future and the time it finished (None
+# while it is still queued or running).
+# The pool is created and replaced under `_job_executor_lock`, since
+# requests are handled on several threads.
+_job_executor = None
+_job_executor_lock = threading.Lock()
+_jobs = {}
+
+
+def _submit_job(fn, *args):
+    """
+    Submit a job to the worker pool, creating the pool on first use. If a
+    worker died (e.g. killed for running out of memory, or crashed on a
+    malformed PDF) the pool is broken for good, so it is replaced and the
+    job is submitted again.
+    """
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ProcessPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+        try:
+            return _job_executor.submit(fn, *args)
+        except BrokenProcessPool:
+            print("⚠️ Job worker pool is broken, starting a new one.")
+            _job_executor.shutdown(wait=False)
+            _job_executor = ProcessPoolExecutor(max_workers=MAX_CONCURRENT_JOBS)
+            return _job_executor.submit(fn, *args)
+
+
+def _remove_job_files(job_id, future):
+    """
+    Delete what a finished job left on disk: the PDF it generated or, if its
+    worker died before it could clean up, the job's upload folder.
+    """
+    if future.cancelled():
+        return
+    if isinstance(future.exception(), BrokenProcessPool):
+        shutil.rmtree(os.path.join(app.config['UPLOAD_FOLDER'], job_id), ignore_errors=True)
+        return
+    if future.exception() is not None:
+        return
+    output_path = future.result()
+    if output_path and os.path.exists(output_path):
+        os.remove(output_path)
+
+
+def _sweep_expired_jobs():
+    """Forget finished jobs whose result was never fetched within the TTL."""
+    now = time.monotonic()
+    for job_id, job in list(_jobs.items()):
+        finished_at = job['finished_at']
+        if finished_at is not None and now - finished_at > JOB_RESULT_TTL:
+            _jobs.pop(job_id, None)
+            _remove_job_files(job_id, job['future'])
+
+
+class _DeleteOnCloseFile(io.FileIO):
+    """
+    A file opened for reading that is deleted from disk once closed. The
+    WSGI server closes it after sending it, and being a real file it still
+    has a fileno() for the server's sendfile(2) path.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+# --- CAPTION PATTERNS ---
+class CaptionPattern:
+    """
+    A caption regex compiled once, guarded by a cheap lowercase substring
+    check so the regex only runs on text blocks containing a keyword.
+    Exposes the same `search` method as a compiled regex.
+    """
+
+    # Python's backtracking engine is fastest on short strings, while RE2's
+    # linear-time DFA wins once a block holds a whole paragraph of text.
+    # RE2's \b, \d and \s only know ASCII, so the DFA is only used on ASCII
+    # blocks, with \s spelled out as the set Python's \s matches there;
+    # every other block keeps Python's Unicode semantics.
+    DFA_MIN_LENGTH = 200
+    _ASCII_SPACE = r"[\t\n\v\f\r\x1c-\x1f ]"
+
+    def __init__(self, pattern, keywords):
+        self.regex = re.compile(pattern, re.IGNORECASE)
+        self.dfa = re2.compile("(?i)" + pattern.replace(r"\s", self._ASCII_SPACE))
+        self.keywords = keywords
+
+    def search(self, text):
+        t_lc = text.lower()
+        for keyword in self.keywords:
+            if keyword in t_lc:
+                if len(text) >= self.DFA_MIN_LENGTH and text.isascii():
+                    return self.dfa.search(text)
+                return self.regex.search(text)
+        return None
+
+
+# Common image/figure captions (e.g., "Figure 1", "Fig. 2.3", "Diagram 4")
+_CAP_RE = CaptionPattern(
+    r"(?:figure|fig\.?|table|diagram)\b|(?:figure|fig\.?)\s*\d|^(?:table|diagram)\s*\d",
+    ("fig", "table", "diagram"),
+)
+# Table captions
+_TABLE_CAP_RE = CaptionPattern(r"table\b", ("table",))
+
+
+# --- PER-PAGE CACHE ---
+# Sort key for text blocks: top-to-bottom, then left-to-right
+_BLOCK_KEY = itemgetter(1, 0)
+
+
+class PageCache:
+    """
+    Memoizes the per-page data used by the extraction passes so that
+    PyMuPDF only parses each page's content stream once. For every page
+    number it keeps the loaded page, its text blocks (sorted top-to-bottom,
+    left-to-right) along with a NumPy array of their coordinates, and its
+    embedded images paired with their bounding boxes.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._pages = {}
+
+    def get(self, page_num):
+        """Return the cached data for a page, computing it on first access."""
+        entry = self._pages.get(page_num)
+        if entry is None:
+            page = self.document.load_page(page_num)
+            image_bboxes = []
+            for img_data in page.get_images(full=True):
+                try:
+                    irect = page.get_image_bbox(img_data)
+                except Exception:
+                    irect = None
+                image_bboxes.append((img_data, irect))
+
+            blocks = sorted(page.get_text("blocks"), key=_BLOCK_KEY)
+            blocks_np = np.array([b[:4] for b in blocks], dtype=np.float64).reshape(-1, 4)
+            entry = {
+                'page': page,
+                'blocks': blocks,
+                'blocks_np': blocks_np,
+                'block_ys': np.ascontiguousarray(blocks_np[:, 1]),
+                'caption_masks': {},
+                'image_bboxes': image_bboxes,
+            }
+            self._pages[page_num] = entry
+        return entry
+
 
 # --- IMAGE + CAPTION + DESCRIPTION EXTRACTION ---
-def extract_images_with_captions_and_descriptions(pdf_path):
+def extract_images_with_captions_and_descriptions(document, temp_image_dir=TEMP_IMAGE_DIR, page_cache=None):
     """
     Extract images and their complete descriptions from the PDF.
     This function finds image blocks and looks for nearby text that
@@ -39,71 +235,41 @@ def extract_images_with_captions_and_descriptions(pdf_path):
     It then creates a composite rasterized image of the figure plus its
     caption and description to preserve the original layout.
 
+    `document` is an open fitz.Document; pass a shared `page_cache` to reuse
+    page data computed by another pass over the same document.
+
     Returns a list of dictionaries, where each dict represents a figure entry.
     """
-    document = fitz.open(pdf_path)
-    temp_image_dir = "temp_extracted_images"
-    if not os.path.exists(temp_image_dir):
-        os.makedirs(temp_image_dir)
-
     image_entries = []
-    seen_hashes = set()
+    seen_hashes = {}
+    if page_cache is None:
+        page_cache = PageCache(document)
 
     for page_num in range(len(document)):
-        page = document.load_page(page_num)
-        images = page.get_images(full=True)
-        text_blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
-        
-        # Regex to find common image/figure captions
-        cap_patterns = [
-            r".*?(figure|fig\.?|table|diagram)\b",
-            r"^(figure|fig\.?|table|diagram)\s*\d+",
-            r".*?(fig\.?\s*\d+)",
-            r".*?(figure\s*\d+)",
-        ]
-        cap_re = re.compile("|".join(cap_patterns), re.IGNORECASE)
-
-        for i, img_data in enumerate(images):
+        cached = page_cache.get(page_num)
+        page = cached['page']
+        text_blocks = cached['blocks']
+
+        for i, (img_data, rect) in enumerate(cached['image_bboxes']):
             xref = img_data[0]
             base_image = document.extract_image(xref)
             image_bytes = base_image["image"]
             image_ext = base_image["ext"]
+            image_size = (base_image["width"], base_image["height"])
 
-            # Use a hash to avoid processing the same image twice (common in PDFs)
-            h = hashlib.md5(image_bytes).hexdigest()
-            if h in seen_hashes:
+            # Use a hash to avoid processing the same image twice (common in PDFs).
+            # The key only covers the image size and its first bytes; the full
+            # contents are compared only when two images share a key.
+            h = (len(image_bytes), xxhash.xxh3_64_intdigest(memoryview(image_bytes)[:HASH_PREFIX_BYTES]))
+            if _is_duplicate_image(document, xref, image_bytes, h, seen_hashes):
                 continue
-            seen_hashes.add(h)
 
-            # Get the image's bounding box on the page
-            rect = page.get_image_bbox(img_data)
+            # Skip images without a usable bounding box on the page
             if not rect:
                 continue
 
             # Find the nearest caption block
-            best_idx = None
-            best_distance = float('inf')
-            
-            # Search for a caption below the image first, then above
-            for idx, block in enumerate(text_blocks):
-                bx, by, bw, bh, bt, *_ = block
-                t = bt.strip()
-                if not t or not cap_re.search(t):
-                    continue
-                
-                # Check for proximity to the image's bounding box
-                # Below
-                if 0 <= by - rect.y1 <= 150 and abs(bx - rect.x0) < rect.width:
-                    d = by - rect.y1
-                    if d < best_distance:
-                        best_distance = d
-                        best_idx = idx
-                # Above
-                elif 0 <= rect.y0 - (by + bh) <= 100 and abs(bx - rect.x0) < rect.width:
-                    d = rect.y0 - (by + bh)
-                    if d < best_distance:
-                        best_distance = d
-                        best_idx = idx
+            best_idx = _find_nearest_caption(cached, rect, _CAP_RE)
 
             caption_text = None
             description_text = None
@@ -112,7 +278,7 @@ def extract_images_with_captions_and_descriptions(pdf_path):
             if best_idx is not None:
                 # Merge the caption block and any subsequent description blocks
                 caption_text, description_text, caption_rect, desc_rect = _merge_text_blocks(
-                    text_blocks, best_idx, cap_re
+                    text_blocks, best_idx, _CAP_RE
                 )
 
                 # Create a composite clip that includes the image, caption, and description
@@ -133,11 +299,14 @@ def extract_images_with_captions_and_descriptions(pdf_path):
 
                 try:
                     # Rasterize the composite clip into a single image
-                    pix = page.get_pixmap(clip=clip, matrix=fitz.Matrix(2, 2))
+                    pix = page.get_pixmap(
+                        clip=clip, matrix=_raster_matrix(clip), alpha=False, colorspace=fitz.csRGB
+                    )
                     composite_path = os.path.join(
                         temp_image_dir, f"figure_p{page_num+1}_{i+1}_composite.png"
                     )
                     pix.save(composite_path)
+                    image_size = (pix.width, pix.height)
                     print(f"📸 Created composite figure image for page {page_num+1}.")
                 except Exception as e_img:
                     print(f"⚠️ Could not rasterize composite figure on page {page_num+1}: {e_img}")
@@ -145,13 +314,24 @@ def extract_images_with_captions_and_descriptions(pdf_path):
             # Save the original image as a fallback
             image_path = os.path.join(temp_image_dir, f"page_{page_num+1}_{i+1}.{image_ext}")
             try:
-                img = PILImage.open(io.BytesIO(image_bytes))
-                if img.mode == "CMYK":
-                    img = img.convert("RGB")
-                img.save(image_path)
+                if image_ext in ("png", "jpeg") and base_image.get("colorspace") != 4:
+                    # Already a JPEG/PNG in a colorspace PDF readers and ReportLab
+                    # handle, so write the embedded bytes verbatim
+                    with open(image_path, "wb") as f:
+                        f.write(image_bytes)
+                else:
+                    # CMYK and less common formats go through PIL
+                    with PILImage.open(io.BytesIO(image_bytes)) as img:
+                        if img.mode == "CMYK":
+                            img = img.convert("RGB")
+                        img.save(image_path)
             except Exception as e:
                 print(f"❌ Could not save image from page {page_num+1}: {e}")
                 continue
+            finally:
+                # Drop the raw image buffer as soon as it is on disk so large
+                # embedded scans don't stay resident alongside the next one
+                del image_bytes, base_image
 
             image_entries.append({
                 'type': 'image',
@@ -162,29 +342,65 @@ def extract_images_with_captions_and_descriptions(pdf_path):
                 'caption': caption_text,
                 'description': description_text,
                 'hash': h,
+                # Pixel size of the image the PDF build will use (composite first)
+                'width': image_size[0],
+                'height': image_size[1],
             })
 
-    document.close()
+        # Release MuPDF's internal cache of decoded images for this page
+        fitz.TOOLS.store_shrink(100)
+
     return image_entries
 
 
+# --- HELPER FUNCTION FOR IMAGE DEDUPLICATION ---
+def _is_duplicate_image(document, xref, image_bytes, key, seen_hashes):
+    """
+    Helper function to check whether an image was already extracted.
+    `seen_hashes` maps each (length, prefix hash) key to a list of
+    [xref, full hash] pairs and is updated in place. Full hashes are only
+    computed, and earlier images only re-read, when a key is shared.
+    """
+    candidates = seen_hashes.setdefault(key, [])
+    full_hash = None
+    for candidate in candidates:
+        # The same image object reused on several pages, or an image small
+        # enough for the prefix hash to cover all of it
+        if candidate[0] == xref or len(image_bytes) <= HASH_PREFIX_BYTES:
+            return True
+        if full_hash is None:
+            full_hash = xxhash.xxh3_64_intdigest(image_bytes)
+        if candidate[1] is None:
+            candidate[1] = xxhash.xxh3_64_intdigest(document.extract_image(candidate[0])["image"])
+        if candidate[1] == full_hash:
+            return True
+    candidates.append([xref, full_hash])
+    return False
+
+
 # --- TABLE EXTRACTION WITH DESCRIPTIONS ---
-def extract_tables_with_captions_and_descriptions(pdf_path):
+def extract_tables_with_captions_and_descriptions(document, pdf_path, temp_image_dir=TEMP_IMAGE_DIR, page_cache=None, camelot_workers=1):
     """
     Extracts tables using Camelot and attempts to find their captions and descriptions.
     The function is designed to handle tables with embedded diagrams by rasterizing them.
 
+    `document` is the open fitz.Document for `pdf_path`; Camelot still reads
+    the file itself. Pass a shared `page_cache` to reuse page data.
+    `camelot_workers` caps the processes Camelot may use to parse pages.
+
     Returns a list of dictionaries, where each dict represents a table entry.
     """
     tables_with_captions = []
-    temp_image_dir = "temp_extracted_images"
-    if not os.path.exists(temp_image_dir):
-        os.makedirs(temp_image_dir)
-        
+
     try:
-        # Use Camelot's lattice mode first, which is better for structured tables
-        tables = camelot.read_pdf(pdf_path, pages="all", flavor="lattice")
-        document = fitz.open(pdf_path)
+        # Use Camelot's lattice mode first, which is better for structured tables.
+        # Pages are parsed in parallel across processes by Camelot itself.
+        tables = camelot.read_pdf(
+            pdf_path, pages="all", flavor="lattice", backend=CAMELOT_BACKEND,
+            parallel=camelot_workers > 1, cpu_count=camelot_workers,
+        )
+        if page_cache is None:
+            page_cache = PageCache(document)
         seen_tables = set()
 
         def good_tables(iterable):
@@ -200,23 +416,22 @@ def extract_tables_with_captions_and_descriptions(pdf_path):
                     continue
                 yield t, data
 
+        to_rasterize = []
         extracted_any = False
         for t, data in good_tables(tables):
             # Check for duplicate tables on the same page
-            serialized = f"{t.page}|{repr(data)}"
-            if serialized in seen_tables:
+            fingerprint = _table_fingerprint(t.page, data)
+            if fingerprint in seen_tables:
                 continue
-            seen_tables.add(serialized)
+            seen_tables.add(fingerprint)
 
-            page = document.load_page(t.page - 1)
-            text_blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
+            cached = page_cache.get(t.page - 1)
+            page = cached['page']
+            text_blocks = cached['blocks']
             
             caption_text = None
             description_text = None
             y_hint = 999999.0
-            
-            # Regex for table captions
-            table_cap_re = re.compile(r".*?(table)\b", re.IGNORECASE)
 
             # Get the table's bounding box from Camelot
             bbox = getattr(t, 'bbox', None) or getattr(t, '_bbox', None)
@@ -228,28 +443,12 @@ def extract_tables_with_captions_and_descriptions(pdf_path):
 
             # Find the nearest caption block to the table
             best_idx = None
-            best_distance = float('inf')
-            for idx, block in enumerate(text_blocks):
-                bx, by, bw, bh, bt, *_ = block
-                ttext = bt.strip()
-                if not table_cap_re.search(ttext) or not table_rect:
-                    continue
-                
-                # Check for proximity
-                if 0 <= by - table_rect.y1 <= 150 and abs(bx - table_rect.x0) < table_rect.width:
-                    d = by - table_rect.y1
-                    if d < best_distance:
-                        best_distance = d
-                        best_idx = idx
-                elif 0 <= table_rect.y0 - (by + bh) <= 100 and abs(bx - table_rect.x0) < table_rect.width:
-                    d = table_rect.y0 - (by + bh)
-                    if d < best_distance:
-                        best_distance = d
-                        best_idx = idx
-            
+            if table_rect:
+                best_idx = _find_nearest_caption(cached, table_rect, _TABLE_CAP_RE)
+
             if best_idx is not None:
                 caption_text, description_text, caption_rect, desc_rect = _merge_text_blocks(
-                    text_blocks, best_idx, table_cap_re
+                    text_blocks, best_idx, _TABLE_CAP_RE
                 )
                 y_hint = text_blocks[best_idx][1]
                 print(f"📊 Found caption for table on page {t.page}: '{caption_text}'")
@@ -262,16 +461,11 @@ def extract_tables_with_captions_and_descriptions(pdf_path):
             
             if table_rect:
                 # Check for any images intersecting the table's region
-                try:
-                    imgs = page.get_images(full=True)
-                    for img_data in imgs:
-                        irect = page.get_image_bbox(img_data)
-                        if irect and irect.intersects(table_rect):
-                            force_raster = True
-                            print(f"🖼️ Detected an image inside table on page {t.page}, forcing rasterization.")
-                            break
-                except Exception as _e:
-                    pass
+                for _img_data, irect in cached['image_bboxes']:
+                    if irect and irect.intersects(table_rect):
+                        force_raster = True
+                        print(f"🖼️ Detected an image inside table on page {t.page}, forcing rasterization.")
+                        break
 
                 # Build a composite clip of the table, caption, and description
                 composite = fitz.Rect(table_rect)
@@ -296,30 +490,187 @@ def extract_tables_with_captions_and_descriptions(pdf_path):
                 'y_hint': y_hint,
             }
 
-            # If rasterization is forced, create the image file
+            # If rasterization is forced, create the image file below
             if force_raster and clip:
-                try:
-                    pix = page.get_pixmap(clip=clip, matrix=fitz.Matrix(2, 2))
-                    img_path = os.path.join(
-                        temp_image_dir, f"table_p{t.page}_{hash(repr(bbox)) & 0xfffffff}.png"
-                    )
-                    pix.save(img_path)
-                    table_entry['as_image_path'] = img_path
-                    table_entry['y_hint'] = float(min(clip.y0, y_hint))
-                    print(f"✅ Rasterized table on page {t.page}.")
-                except Exception as e_img:
-                    print(f"⚠️ Could not rasterize table on page {t.page}: {e_img}")
+                to_rasterize.append((table_entry, clip, bbox))
 
             tables_with_captions.append(table_entry)
             extracted_any = True
-            
-        document.close()
-        
+
+        # Pages with several tables to rasterize are rendered once, at the
+        # highest zoom any of them needs, and every table is cropped out of
+        # that pixmap. Only the current page is kept, since Camelot returns
+        # tables in page order.
+        rasters_per_page = Counter(entry['page'] for entry, _clip, _bbox in to_rasterize)
+        page_zoom = {}
+        for entry, clip, _bbox in to_rasterize:
+            if rasters_per_page[entry['page']] > 1:
+                zoom = _raster_matrix(clip).a
+                page_zoom[entry['page']] = max(zoom, page_zoom.get(entry['page'], zoom))
+        page_pix = None
+        page_pix_page = None
+
+        for table_entry, clip, bbox in to_rasterize:
+            page_num = table_entry['page']
+            page = page_cache.get(page_num - 1)['page']
+            try:
+                if page_num in page_zoom:
+                    matrix = fitz.Matrix(page_zoom[page_num], page_zoom[page_num])
+                    if page_pix_page != page_num:
+                        page_pix = page.get_pixmap(
+                            matrix=matrix, alpha=False, colorspace=fitz.csRGB
+                        )
+                        page_pix_page = page_num
+                    pix = _crop_pixmap(page_pix, clip, matrix)
+                else:
+                    matrix = _raster_matrix(clip)
+                    pix = page.get_pixmap(
+                        clip=clip, matrix=matrix, alpha=False, colorspace=fitz.csRGB
+                    )
+                bbox_hash = xxhash.xxh3_64_intdigest(struct.pack("4d", *bbox))
+                img_path = os.path.join(
+                    temp_image_dir, f"table_p{page_num}_{bbox_hash & 0xfffffff}.webp"
+                )
+                _save_pixmap(pix, img_path)
+                table_entry['as_image_path'] = img_path
+                table_entry['width'], table_entry['height'] = pix.width, pix.height
+                table_entry['y_hint'] = float(min(clip.y0, table_entry['y_hint']))
+                print(f"✅ Rasterized table on page {page_num}.")
+            except Exception as e_img:
+                print(f"⚠️ Could not rasterize table on page {page_num}: {e_img}")
+
     except Exception as e:
         print(f"⚠️ Table extraction failed: {e}")
     return tables_with_captions
 
 
+# --- HELPER FUNCTIONS FOR RASTERIZATION ---
+def _raster_matrix(clip):
+    """
+    Helper function to pick the zoom used to rasterize `clip`. The output PDF
+    draws images within a 450x600 box, so more resolution than that is thrown
+    away. The zoom is clamped to [1, 2] and rounded up to a multiple of 0.5.
+    """
+    scale = max(450 / clip.width, 600 / clip.height)
+    scale = min(2.0, max(1.0, math.ceil(scale * 2) / 2))
+    return fitz.Matrix(scale, scale)
+
+
+
+def _crop_pixmap(page_pix, clip, matrix):
+    """
+    Helper function to cut the region `clip` (in page coordinates) out of a
+    pixmap of the whole page that was rendered with `matrix`.
+    """
+    irect = (clip * matrix).irect & page_pix.irect
+    pix = fitz.Pixmap(page_pix.colorspace, irect, page_pix.alpha)
+    pix.copy(page_pix, irect)
+    return pix
+
+
+def _save_pixmap(pix, path):
+    """
+    Helper function to save an RGB pixmap as a lossless WebP image. For
+    rasterized tables (mostly text and rules) this encodes as fast as PNG
+    while producing files several times smaller.
+    """
+    img = PILImage.frombuffer(
+        "RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1
+    )
+    img.save(path, format="WEBP", lossless=True, method=0)
+
+
+# --- PER-FILE PIPELINE ---
+def process_one_pdf(filepath, temp_root, camelot_workers=1):
+    """
+    Run the image and table extraction passes on a single PDF.
+    This is executed in a worker process, so intermediate images are written
+    to a per-process subdirectory of `temp_root` to avoid collisions between
+    workers. Camelot may use up to `camelot_workers` processes of its own.
+
+    Returns a tuple of (image_entries, tables).
+    """
+    print(f"Processing {os.path.basename(filepath)}...")
+    temp_image_dir = tempfile.mkdtemp(prefix=f"{os.getpid()}_", dir=temp_root)
+
+    # Open the document once and share it, and its page cache, between both passes
+    with fitz.open(filepath) as document:
+        page_cache = PageCache(document)
+        image_entries = extract_images_with_captions_and_descriptions(
+            document, temp_image_dir, page_cache
+        )
+        tables = extract_tables_with_captions_and_descriptions(
+            document, filepath, temp_image_dir, page_cache, camelot_workers
+        )
+    fitz.TOOLS.store_shrink(100)
+    return image_entries, tables
+
+
+# --- HELPER FUNCTION FOR CAPTION LOOKUP ---
+def _caption_mask(cached, cap_re):
+    """
+    Helper function returning a boolean array marking which of a page's
+    sorted text blocks match `cap_re`. Computed once per page and pattern.
+    """
+    mask = cached['caption_masks'].get(cap_re)
+    if mask is None:
+        mask = np.fromiter(
+            (bool(t) and cap_re.search(t) is not None
+             for t in (b[4].strip() for b in cached['blocks'])),
+            dtype=bool,
+            count=len(cached['blocks']),
+        )
+        cached['caption_masks'][cap_re] = mask
+    return mask
+
+
+def _find_nearest_caption(cached, rect, cap_re):
+    """
+    Helper function to find the caption block closest to `rect`, searching
+    up to 150pt below it and 100pt above it. Returns the block index or None.
+
+    Blocks are sorted by their top coordinate, so a binary search cuts off
+    everything starting more than 150pt below the rect; the distances for
+    the remaining blocks are computed with vectorized NumPy operations.
+    """
+    end = int(np.searchsorted(cached['block_ys'], rect.y1 + 150, side='right'))
+    if end == 0:
+        return None
+
+    blocks = cached['blocks_np'][:end]
+    bx, by, bh = blocks[:, 0], blocks[:, 1], blocks[:, 3]
+
+    # Check for proximity to the bounding box, preferring a caption below
+    dy_below = by - rect.y1
+    dy_above = rect.y0 - (by + bh)
+    below = (dy_below >= 0) & (dy_below <= 150)
+    above = (dy_above >= 0) & (dy_above <= 100)
+    valid = (below | above) & (np.abs(bx - rect.x0) < rect.width)
+    valid &= _caption_mask(cached, cap_re)[:end]
+    if not valid.any():
+        return None
+
+    distance = np.where(valid, np.where(below, dy_below, dy_above), np.inf)
+    return int(np.argmin(distance))
+
+
+# --- HELPER FUNCTION FOR TABLE DEDUPLICATION ---
+def _table_fingerprint(page, data):
+    """
+    Helper function to hash a table's page number and cell contents into a
+    64-bit key, feeding the cells to the hasher one by one instead of
+    building a string of the whole table first.
+    """
+    h = xxhash.xxh3_64()
+    h.update(str(page).encode())
+    for row in data:
+        h.update(b"\x1e")  # row separator
+        for cell in row:
+            h.update(str(cell).encode("utf-8", "ignore"))
+            h.update(b"\x1f")  # cell separator
+    return h.intdigest()
+
+
 # --- HELPER FUNCTION FOR TEXT BLOCK MERGING ---
 def _merge_text_blocks(text_blocks_sorted, start_idx, cap_re):
     """
@@ -364,19 +715,34 @@ def _merge_text_blocks(text_blocks_sorted, start_idx, cap_re):
 
 
 # --- PDF BUILD ---
-def build_pdf_with_images_and_tables(image_entries, tables, output_filename="images_and_tables.pdf"):
+def _fitted_image(path, item, max_width=450, max_height=600):
+    """
+    Helper function to create a ReportLab image scaled to fit within
+    max_width x max_height, keeping its aspect ratio. Uses the pixel size
+    recorded at extraction time when available; otherwise ReportLab reads
+    it from the image header.
+    """
+    img_width, img_height = item.get('width'), item.get('height')
+    if not img_width or not img_height:
+        return Image(path, width=max_width, height=max_height, kind='proportional')
+    scale = min(max_width / img_width, max_height / img_height)
+    return Image(path, width=img_width * scale, height=img_height * scale)
+
+
+def build_pdf_with_images_and_tables(image_entries, tables, output_filename=None):
     """
     Build a PDF from the extracted images and tables, maintaining their original order.
     Items are sorted by their original page and vertical position.
-    """
-    output_dir = os.path.join(os.path.dirname(__file__), "generate-pdf")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
-    output_path = os.path.join(output_dir, output_filename)
-    buffer = io.BytesIO()
+    The PDF is written straight to the `generate-pdf` directory and its path is returned.
+    Without an `output_filename` a unique name is used, so concurrent builds never
+    write to (or serve) the same file.
+    """
+    if output_filename is None:
+        output_filename = f"images_and_tables_{uuid.uuid4().hex}.pdf"
+    output_path = os.path.join(OUTPUT_DIR, output_filename)
 
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    doc = SimpleDocTemplate(output_path, pagesize=letter)
     story = []
     styles = getSampleStyleSheet()
     normal = styles["Normal"]
@@ -401,17 +767,7 @@ def build_pdf_with_images_and_tables(image_entries, tables, output_filename="ima
                 # Prioritize the composite image if available
                 img_source_path = item.get('composite_path') or item['path']
                 
-                # Use PIL to get dimensions and scale the image
-                pil_img = PILImage.open(img_source_path)
-                if pil_img.mode != "RGB":
-                    pil_img = pil_img.convert("RGB")
-                img_width, img_height = pil_img.size
-                max_width, max_height = 450, 600
-                scale = min(max_width / img_width, max_height / img_height)
-                new_width = img_width * scale
-                new_height = img_height * scale
-                
-                img = Image(img_source_path, width=new_width, height=new_height)
+                img = _fitted_image(img_source_path, item)
                 
                 # Check if we should add a separate caption/description
                 if item.get('composite_path'):
@@ -437,13 +793,7 @@ def build_pdf_with_images_and_tables(image_entries, tables, output_filename="ima
                 img_path = item.get('as_image_path')
                 if img_path and os.path.exists(img_path):
                     # Add the rasterized table image
-                    pil_img = PILImage.open(img_path)
-                    if pil_img.mode != "RGB":
-                        pil_img = pil_img.convert("RGB")
-                    img_width, img_height = pil_img.size
-                    max_width, max_height = 450, 600
-                    scale = min(max_width / img_width, max_height / img_height)
-                    img = Image(img_path, width=img_width * scale, height=img_height * scale)
+                    img = _fitted_image(img_path, item)
                     story.append(KeepTogether([img]))
                 else:
                     # Fallback to a vector table if no image path exists
@@ -470,19 +820,68 @@ def build_pdf_with_images_and_tables(image_entries, tables, output_filename="ima
                 print(f"❌ Could not add table from page {item['page']}: {e}")
 
     doc.build(story)
-    
-    buffer.seek(0)
-    # Save the file to the local directory as a check
-    with open(output_path, "wb") as f:
-        f.write(buffer.getbuffer())
     print(f"✅ PDF saved to {output_path}")
-    return buffer
+    return output_path
 
 
-# --- ROUTE ---
+# --- JOB ---
+def process_and_build(saved_paths, output_filename):
+    """
+    Extract images and tables from the uploaded PDFs and build the output PDF.
+    This runs as a background job; the uploaded files are removed once done.
+
+    Returns the path of the generated PDF, or None if nothing was found.
+    """
+    # All intermediate images live in a temporary directory that is
+    # removed as soon as the output PDF has been built
+    with tempfile.TemporaryDirectory(dir=TEMP_IMAGE_DIR) as temp_root:
+        # Each PDF is independent and CPU-bound, so extract them in parallel.
+        # Processes are used instead of threads because Camelot/Ghostscript
+        # are not thread-safe. Results are kept in upload order.
+        results = [None] * len(saved_paths)
+        try:
+            cpu_count = os.cpu_count() or 1
+            max_workers = min(len(saved_paths), cpu_count)
+            # Split the cores between the file workers of every running job,
+            # so nested Camelot pools don't multiply the process count
+            camelot_workers = max(1, cpu_count // (max_workers * MAX_CONCURRENT_JOBS))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(process_one_pdf, filepath, temp_root, camelot_workers): idx
+                    for idx, filepath in enumerate(saved_paths)
+                }
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+        finally:
+            for filepath in saved_paths:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                    print(f"Cleaned up temporary file {filepath}.")
+            upload_dir = os.path.dirname(saved_paths[0])
+            if os.path.isdir(upload_dir) and not os.listdir(upload_dir):
+                os.rmdir(upload_dir)
+
+        all_image_entries = []
+        all_tables = []
+        for image_entries, tables in results:
+            all_image_entries.extend(image_entries)
+            all_tables.extend(tables)
+
+        if not all_image_entries and not all_tables:
+            return None
+
+        output_path = build_pdf_with_images_and_tables(all_image_entries, all_tables, output_filename)
+    print("Cleaned up temporary image directory.")
+    return output_path
+
+
+# --- ROUTES ---
 @app.route('/upload-pdfs', methods=['POST'])
 def upload_files():
-    """Main route to handle PDF uploads and generate the new PDF."""
+    """
+    Main route to handle PDF uploads. The PDFs are processed in the background;
+    returns a job id to poll at /result/<job_id> for the generated PDF.
+    """
     try:
         if 'pdfFile' not in request.files:
             return jsonify({'error': 'No file part in the request'}), 400
@@ -491,54 +890,74 @@ def upload_files():
         if not files:
             return jsonify({'error': 'No selected files'}), 400
 
-        upload_folder = app.config['UPLOAD_FOLDER']
-        if not os.path.exists(upload_folder):
-            os.makedirs(upload_folder)
+        _sweep_expired_jobs()
 
-        all_image_entries = []
-        all_tables = []
+        # Each job gets its own upload folder so concurrent uploads of files
+        # with the same name don't overwrite each other
+        job_id = uuid.uuid4().hex
+        upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], job_id)
+        os.makedirs(upload_folder)
 
-        for file in files:
-            filename = secure_filename(file.filename)
+        saved_paths = []
+        for idx, file in enumerate(files):
+            # Prefix with the upload index: different names can sanitize to
+            # the same one (e.g. non-ASCII names all become "pdf")
+            filename = f"{idx}_{secure_filename(file.filename)}"
             filepath = os.path.join(upload_folder, filename)
             file.save(filepath)
+            saved_paths.append(filepath)
 
-            print(f"Processing {filename}...")
-            
-            # Extract images and tables
-            image_entries = extract_images_with_captions_and_descriptions(filepath)
-            all_image_entries.extend(image_entries)
-            
-            tables = extract_tables_with_captions_and_descriptions(filepath)
-            all_tables.extend(tables)
-
-            os.remove(filepath)
-            print(f"Cleaned up temporary file {filepath}.")
-
-        if not all_image_entries and not all_tables:
-            return jsonify({'error': 'No images or tables found in the uploaded PDF(s).'}), 400
-
-        pdf_buffer = build_pdf_with_images_and_tables(all_image_entries, all_tables, "images_and_tables.pdf")
-
-        # Cleanup extracted images and temporary directory
-        temp_image_dir = "temp_extracted_images"
-        if os.path.exists(temp_image_dir):
-            for file_name in os.listdir(temp_image_dir):
-                os.remove(os.path.join(temp_image_dir, file_name))
-            os.rmdir(temp_image_dir)
-            print("Cleaned up temporary image directory.")
-
-        return send_file(
-            pdf_buffer,
-            as_attachment=True,
-            download_name='images_and_tables.pdf',
-            mimetype='application/pdf'
+        future = _submit_job(
+            process_and_build, saved_paths, f"images_and_tables_{job_id}.pdf"
         )
+        job = {'future': future, 'finished_at': None}
+        # The result's TTL starts when the job finishes, not when it is queued
+        future.add_done_callback(lambda _f: job.update(finished_at=time.monotonic()))
+        _jobs[job_id] = job
+        print(f"Queued job {job_id} for {len(saved_paths)} file(s).")
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
     except Exception as e:
         print("===== /upload-pdfs ERROR =====")
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/result/<job_id>', methods=['GET'])
+def get_result(job_id):
+    """
+    Route to poll a job; returns the generated PDF once it is ready. A
+    finished job's result is handed out once and then discarded.
+    """
+    job = _jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+    future = job['future']
+    if not future.done():
+        return jsonify({'job_id': job_id, 'status': 'pending'}), 202
+    _jobs.pop(job_id, None)
+
+    try:
+        output_path = future.result()
+    except Exception as e:
+        print("===== /result ERROR =====")
+        traceback.print_exception(type(e), e, e.__traceback__)
+        _remove_job_files(job_id, future)
+        return jsonify({'error': str(e)}), 500
+
+    if output_path is None:
+        return jsonify({'error': 'No images or tables found in the uploaded PDF(s).'}), 400
+
+    # The generated PDF is deleted once the server has sent and closed it
+    pdf_file = _DeleteOnCloseFile(output_path)
+    response = send_file(
+        pdf_file,
+        as_attachment=True,
+        download_name='images_and_tables.pdf',
+        mimetype='application/pdf'
+    )
+    response.content_length = os.fstat(pdf_file.fileno()).st_size
+    return response
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True)
\ No newline at end of file